@@ -11,20 +11,30 @@ Usage:
     python scripts/fetch-prod-logs.py --since yesterday      # Since yesterday
     python scripts/fetch-prod-logs.py --since "Jan 25 2pm"   # Since specific time
     python scripts/fetch-prod-logs.py --list                 # List without downloading
+    python scripts/fetch-prod-logs.py -o /tmp/prod           # Re-runs skip unchanged files
 """
 
 import argparse
 import ftplib
-import gzip
+import os
+import re
 import ssl
 import sys
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timezone
 from pathlib import Path
+from typing import Callable, Iterator
 
 import dateparser
 
 
-# Remote paths to download (relative to public_html/tub/backend/)
+# Remote root of the backend deployment
+REMOTE_BASE_PATH = '/public_html/tub/backend'
+
+# Remote paths to download (relative to REMOTE_BASE_PATH)
 REMOTE_PATHS = {
     'logs': 'storage/logs',
     'state': 'storage/state',
@@ -32,17 +42,25 @@ REMOTE_PATHS = {
     'scheduled-jobs': 'storage/scheduled-jobs',
 }
 
+# KEY=value lines; comments, blank lines and empty keys never match
+ENV_LINE_RE = re.compile(r'^[ \t]*([^#=\s][^=\n]*)=(.*?)[ \t]*$', re.MULTILINE)
+
+# Concurrent FTP connections; shared hosts commonly cap logins per user
+MAX_FTP_CONNECTIONS = 4
+
+# Seconds before a stalled connect/login/recv gives up; also bounds how long
+# Ctrl+C can wait on a worker stuck in a socket call
+FTP_TIMEOUT = 30
+
+# RETR read size. Over TLS each recv still returns at most one ~16 KiB record,
+# so this mainly saves retrbinary loop iterations rather than syscalls
+DOWNLOAD_BLOCKSIZE = 1024 * 1024
+
 
 def parse_env_file(env_path: str) -> dict:
     """Parse the env.production file to extract FTP credentials."""
-    creds = {}
-    with open(env_path, 'r') as f:
-        for line in f:
-            line = line.strip().replace('\r', '')
-            if '=' in line and not line.startswith('#'):
-                key, val = line.split('=', 1)
-                creds[key] = val
-    return creds
+    text = Path(env_path).read_text().replace('\r', '')
+    return dict(ENV_LINE_RE.findall(text))
 
 
 def connect_ftp(host: str, user: str, password: str) -> ftplib.FTP_TLS:
@@ -51,103 +69,219 @@ def connect_ftp(host: str, user: str, password: str) -> ftplib.FTP_TLS:
     context.check_hostname = False
     context.verify_mode = ssl.CERT_NONE
 
-    ftp = ftplib.FTP_TLS(host, context=context)
+    ftp = ftplib.FTP_TLS(host, context=context, timeout=FTP_TIMEOUT)
     ftp.login(user, password)
     ftp.prot_p()
 
     return ftp
 
 
-def parse_ftp_list(line: str) -> tuple[str, datetime | None]:
-    """
-    Parse a line from FTP LIST command to extract filename and modification time.
-
-    Example line: "-rw-r--r--    1 misuse     misuse         327697 Jan 25 11:42 api.log"
-    """
-    parts = line.split()
-    if len(parts) < 9:
-        return None, None
-
-    filename = ' '.join(parts[8:])  # Handle filenames with spaces
+def quit_ftp(ftp: ftplib.FTP_TLS) -> None:
+    """Say QUIT, falling back to dropping the socket if the server doesn't answer."""
+    try:
+        ftp.quit()
+    except ftplib.all_errors:
+        ftp.close()
 
-    # Parse date - format is "Mon DD HH:MM" or "Mon DD  YYYY"
-    month_str = parts[5]
-    day = int(parts[6])
-    time_or_year = parts[7]
 
-    months = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
-              'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12}
-    month = months.get(month_str, 1)
+class FtpConnectionPool:
+    """
+    Lends FTP connections to worker threads.
 
-    now = datetime.now()
+    FTP_TLS connections are not thread-safe, so a connection is only ever
+    touched by the thread that borrowed it. Connections are opened on
+    demand and returned for reuse after each task; close() quits only the
+    idle ones, and a connection still borrowed at that point is quit by
+    its borrower when it comes back.
+    """
 
-    if ':' in time_or_year:
-        # Recent file: "HH:MM" format, assume current year
-        hour, minute = map(int, time_or_year.split(':'))
-        year = now.year
-        # If the date is in the future, it's probably last year
-        mod_time = datetime(year, month, day, hour, minute)
-        if mod_time > now:
-            mod_time = datetime(year - 1, month, day, hour, minute)
-    else:
-        # Older file: year format
-        year = int(time_or_year)
-        mod_time = datetime(year, month, day)
+    def __init__(self, host: str, user: str, password: str):
+        self.host = host
+        self.user = user
+        self.password = password
+        self._lock = threading.Lock()
+        self._idle = []
+        self._closed = False
+
+    @contextmanager
+    def connection(self) -> Iterator[ftplib.FTP_TLS]:
+        """Borrow a connection for the duration of the with block."""
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('FTP connection pool is closed')
+            ftp = self._idle.pop() if self._idle else None
+        if ftp is None:
+            ftp = connect_ftp(self.host, self.user, self.password)
+
+        try:
+            yield ftp
+        except BaseException:
+            # A transfer that died midway leaves the control connection in
+            # an unknown state, so never hand it out again
+            ftp.close()
+            raise
+
+        with self._lock:
+            if not self._closed:
+                self._idle.append(ftp)
+                return
+        quit_ftp(ftp)
+
+    def close(self) -> None:
+        """Quit idle connections and stop lending."""
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for ftp in idle:
+            quit_ftp(ftp)
+
+
+def parse_mlsd_time(modify: str) -> datetime:
+    """
+    Parse an MLSD modify fact into a naive local datetime.
 
-    return filename, mod_time
+    MLSD reports times as UTC "YYYYMMDDHHMMSS[.sss]" (RFC 3659); convert to
+    local time so they compare directly with --since and datetime.now().
+    """
+    utc_time = datetime.strptime(modify[:14], '%Y%m%d%H%M%S').replace(tzinfo=timezone.utc)
+    return utc_time.astimezone().replace(tzinfo=None)
 
 
-def list_remote_files_with_times(ftp: ftplib.FTP_TLS, remote_dir: str) -> list[tuple[str, datetime | None]]:
-    """List files in a remote directory with modification times."""
+def list_remote_files_with_times(ftp: ftplib.FTP_TLS, remote_dir: str,
+                                 log: Callable[[str], None] = print
+                                 ) -> list[tuple[str, datetime | None, int | None]]:
+    """List files in a remote directory with modification times and sizes."""
     try:
-        ftp.cwd(remote_dir)
-        lines = []
-        ftp.retrlines('LIST', lines.append)
-
         files = []
-        for line in lines:
-            if line.startswith('d'):  # Skip directories
+        for filename, facts in ftp.mlsd(remote_dir, facts=['type', 'size', 'modify']):
+            if facts.get('type') != 'file' or filename.startswith('.'):
                 continue
-            filename, mod_time = parse_ftp_list(line)
-            if filename and not filename.startswith('.'):
-                files.append((filename, mod_time))
+            mod_time = parse_mlsd_time(facts['modify']) if 'modify' in facts else None
+            size = int(facts['size']) if 'size' in facts else None
+            files.append((filename, mod_time, size))
         return files
     except ftplib.error_perm as e:
-        print(f"  Warning: Cannot access {remote_dir}: {e}")
+        log(f"  Warning: Cannot access {remote_dir}: {e}")
         return []
 
 
-def download_file(ftp: ftplib.FTP_TLS, remote_path: str, local_path: Path) -> bool:
-    """Download a single file."""
+class GunzipWriter:
+    """retrbinary callback that gunzips chunks (all members) into a file as they arrive."""
+
+    def __init__(self, f):
+        self.f = f
+        self.decompressor = zlib.decompressobj(wbits=31)  # 31 = gzip header
+        self.error = None
+
+    def write(self, chunk: bytes) -> None:
+        # Don't raise mid-transfer: retrbinary would abandon the transfer
+        # reply on the control connection and desync later commands
+        if self.error:
+            return
+        try:
+            while chunk:
+                # A gzip file may hold several concatenated members; a
+                # decompressobj stops after one and parks the rest in
+                # unused_data, so start a fresh one for each member
+                if self.decompressor.eof:
+                    self.decompressor = zlib.decompressobj(wbits=31)
+                self.f.write(self.decompressor.decompress(chunk))
+                chunk = self.decompressor.unused_data
+        except zlib.error as e:
+            self.error = e
+
+    def finish(self) -> None:
+        """Flush remaining output, raising zlib.error if the stream was bad."""
+        if self.error:
+            raise self.error
+        if not self.decompressor.eof:
+            raise zlib.error('truncated gzip stream')
+        self.f.write(self.decompressor.flush())
+
+
+class DownloadCancelled(Exception):
+    """Raised inside a transfer when the fetch is being abandoned."""
+
+
+def download_file(ftp: ftplib.FTP_TLS, remote_path: str, local_path: Path,
+                  decompress: bool = False, log: Callable[[str], None] = print,
+                  stop: threading.Event | None = None) -> bool:
+    """
+    Download a single file.
+
+    With decompress, the remote file is gunzipped on the fly so only the
+    uncompressed copy is written to local_path. The parent directory must
+    already exist. Setting stop aborts the transfer at the next block with
+    DownloadCancelled; the connection is then unusable and must be dropped.
+    Any transfer that raises leaves no partial file behind.
+    """
     try:
-        local_path.parent.mkdir(parents=True, exist_ok=True)
         with open(local_path, 'wb') as f:
-            ftp.retrbinary(f'RETR {remote_path}', f.write)
+            writer = GunzipWriter(f) if decompress else None
+            write = writer.write if writer else f.write
+
+            def write_block(chunk: bytes) -> None:
+                if stop is not None and stop.is_set():
+                    raise DownloadCancelled(remote_path)
+                write(chunk)
+
+            ftp.retrbinary(f'RETR {remote_path}', write_block, DOWNLOAD_BLOCKSIZE)
+            if writer:
+                writer.finish()
         return True
     except ftplib.error_perm as e:
-        print(f"  Warning: Cannot download {remote_path}: {e}")
+        log(f"  Warning: Cannot download {remote_path}: {e}")
         return False
+    except zlib.error as e:
+        log(f"  Warning: Cannot decompress {remote_path}: {e}")
+        local_path.unlink(missing_ok=True)
+        return False
+    except BaseException:
+        local_path.unlink(missing_ok=True)
+        raise
 
 
-def decompress_gzip(gz_path: Path) -> Path:
-    """Decompress a .gz file and return the decompressed path."""
-    if not gz_path.suffix == '.gz':
-        return gz_path
+def local_name_for(filename: str, remote_names: set[str], decompress: bool,
+                   log: Callable[[str], None] = print) -> tuple[str, bool]:
+    """
+    Choose the local name for a remote file and whether to gunzip it.
 
-    decompressed_path = gz_path.with_suffix('')
-    try:
-        with gzip.open(gz_path, 'rb') as f_in:
-            with open(decompressed_path, 'wb') as f_out:
-                f_out.write(f_in.read())
-        return decompressed_path
-    except Exception as e:
-        print(f"  Warning: Cannot decompress {gz_path}: {e}")
-        return gz_path
+    LogRotationService compresses an idle X.log to X.log.gz, after which a
+    fresh X.log can appear beside it. Gunzipping the archive would then
+    overwrite the live log, so in that case the archive is kept compressed.
+    """
+    if not decompress or not filename.endswith('.gz'):
+        return filename, False
 
+    plain_name = filename[:-len('.gz')]
+    if plain_name in remote_names:
+        log(f"  Warning: Keeping {filename} compressed; {plain_name} also exists remotely")
+        return filename, False
+    return plain_name, True
 
-def format_time_ago(dt: datetime) -> str:
-    """Format a datetime as a human-readable 'time ago' string."""
-    now = datetime.now()
+
+def plan_local_names(filenames: list[str], decompress: bool,
+                     log: Callable[[str], None] = print) -> dict[str, tuple[str, bool]]:
+    """
+    Map every remote file in a directory to (local name, gunzip).
+
+    Transfers run concurrently, so two remote files must never resolve to
+    the same local file; any clash falls back to the remote name as-is.
+    """
+    remote_names = set(filenames)
+    plan = {}
+    claimed = set()
+    for filename in filenames:
+        local_name, gunzip = local_name_for(filename, remote_names, decompress, log)
+        if local_name in claimed:
+            local_name, gunzip = filename, False
+        claimed.add(local_name)
+        plan[filename] = (local_name, gunzip)
+    return plan
+
+
+def format_time_ago(dt: datetime, now: datetime) -> str:
+    """Format a datetime as a human-readable 'time ago' string relative to now."""
     diff = now - dt
 
     if diff.days > 0:
@@ -160,17 +294,78 @@ def format_time_ago(dt: datetime) -> str:
         return "just now"
 
 
+def list_category(pool: FtpConnectionPool, remote_dir: str
+                  ) -> tuple[list[tuple[str, datetime | None, int | None]], list[str]]:
+    """List a remote directory on a pooled connection. Returns (files, output lines)."""
+    lines = []
+    with pool.connection() as ftp:
+        files = list_remote_files_with_times(ftp, remote_dir, lines.append)
+    # Names are unique, so tuple order is filename order
+    return sorted(files), lines
+
+
+def fetch_file(pool: FtpConnectionPool, remote_path: str, local_path: Path,
+               decompress: bool, mod_time: datetime | None,
+               stop: threading.Event) -> tuple[bool, list[str]]:
+    """
+    Download one file on a pooled connection. Returns (success, output lines).
+
+    The local copy is stamped with the remote mtime so later runs into the
+    same output directory can tell it is unchanged. FTP and socket errors
+    (timeouts, 421s, a refused extra login) fail just this file; the pool
+    has already dropped the connection by the time they get here.
+    """
+    lines = []
+    try:
+        with pool.connection() as ftp:
+            ok = download_file(ftp, remote_path, local_path, decompress, lines.append, stop)
+    except ftplib.all_errors as e:
+        lines.append(f"  Warning: Cannot download {remote_path}: {e}")
+        return False, lines
+    if ok and mod_time:
+        os.utime(local_path, (datetime.now().timestamp(), mod_time.timestamp()))
+    return ok, lines
+
+
+def is_unchanged(local_path: Path, mod_time: datetime | None, size: int | None) -> bool:
+    """
+    True if local_path was fetched earlier and the remote file hasn't moved.
+
+    Only meaningful because plan_local_names maps remote to local files
+    one-to-one, so the stamped mtime always came from this remote file.
+    Pass size for plain copies; gunzipped copies can only match on mtime.
+    """
+    if mod_time is None or not local_path.exists():
+        return False
+    stat = local_path.stat()
+    if size is not None and stat.st_size != size:
+        return False
+    # MLSD times have 1s resolution; allow only float rounding, since live
+    # logs are appended continuously and any later mtime means new content
+    return abs(stat.st_mtime - mod_time.timestamp()) < 1
+
+
 def fetch_logs(env_path: str, output_dir: Path, since: datetime | None = None,
                list_only: bool = False, decompress: bool = True) -> dict:
     """
     Fetch all production logs and state files.
 
+    Listings and individual file downloads run concurrently across up to
+    MAX_FTP_CONNECTIONS connections. Output is buffered and printed in
+    REMOTE_PATHS/filename order so it reads the same as a serial run.
+
+    A file whose transfer hits an FTP or socket error is counted as failed
+    and the rest carry on. Errors while connecting for or running a
+    directory listing still abort the whole fetch, as does Ctrl+C; running
+    transfers then stop at their next block, or within FTP_TIMEOUT if the
+    server has stalled.
+
     Args:
         env_path: Path to env.production file
         output_dir: Local directory to save files
         since: Only download files modified after this time (None = all files)
         list_only: If True, just list files without downloading
-        decompress: If True, decompress .gz files after download
+        decompress: If True, decompress .gz files while downloading
 
     Returns dict with download statistics.
     """
@@ -190,54 +385,102 @@ def fetch_logs(env_path: str, output_dir: Path, since: datetime | None = None,
     print(f"Connecting to {host} as {user}...")
     if since:
         print(f"Filtering: files modified since {since.strftime('%Y-%m-%d %H:%M:%S')}")
-    ftp = connect_ftp(host, user, password)
-
-    base_path = '/public_html/tub/backend'
-    stats = {'downloaded': 0, 'skipped': 0, 'failed': 0, 'bytes': 0}
-
-    for category, remote_subdir in REMOTE_PATHS.items():
-        print(f"\n{'Listing' if list_only else 'Downloading'} {category}/")
 
-        remote_dir = f'{base_path}/{remote_subdir}'
-        files = list_remote_files_with_times(ftp, remote_dir)
-
-        if not files:
-            print("  (no files)")
-            continue
+    stats = {'downloaded': 0, 'skipped': 0, 'unchanged': 0, 'failed': 0, 'bytes': 0}
+    now = datetime.now()
+    pool = FtpConnectionPool(host, user, password)
+    executor = ThreadPoolExecutor(max_workers=MAX_FTP_CONNECTIONS)
+    stop = threading.Event()
 
-        for filename, mod_time in sorted(files, key=lambda x: x[0]):
-            # Filter by modification time if --since was specified
-            if since and mod_time and mod_time < since:
-                stats['skipped'] += 1
+    try:
+        listings = []
+        for category, remote_subdir in REMOTE_PATHS.items():
+            remote_dir = f'{REMOTE_BASE_PATH}/{remote_subdir}'
+            listing = executor.submit(list_category, pool, remote_dir)
+            listings.append((category, remote_dir, listing))
+
+        # Queue every download before reporting anything, so files from
+        # all categories share the pool instead of one category at a time
+        reports = []
+        for category, remote_dir, listing in listings:
+            files, lines = listing.result()
+            downloads = []
+            reports.append((category, lines, downloads))
+
+            if not files:
+                lines.append("  (no files)")
                 continue
 
-            local_file = output_dir / category / filename
-            time_str = format_time_ago(mod_time) if mod_time else "?"
+            local_dir = output_dir / category
+            if not list_only:
+                local_dir.mkdir(parents=True, exist_ok=True)
+
+            # Decide every local name before queueing anything, using the
+            # full listing so files filtered out below still claim theirs
+            local_names = plan_local_names([f[0] for f in files], decompress, lines.append)
+
+            for filename, mod_time, remote_size in files:
+                # Filter by modification time if --since was specified
+                if since and mod_time and mod_time < since:
+                    stats['skipped'] += 1
+                    continue
+
+                time_str = format_time_ago(mod_time, now) if mod_time else "?"
+
+                if list_only:
+                    if remote_size is not None:
+                        lines.append(f"  {filename} ({remote_size:,} bytes, {time_str})")
+                    else:
+                        lines.append(f"  {filename} ({time_str})")
+                    continue
+
+                local_name, gunzip = local_names[filename]
+                local_file = local_dir / local_name
+
+                if is_unchanged(local_file, mod_time, None if gunzip else remote_size):
+                    download = None
+                else:
+                    download = executor.submit(fetch_file, pool, f'{remote_dir}/{filename}',
+                                               local_file, gunzip, mod_time, stop)
+                downloads.append((filename, local_file, gunzip, time_str, download))
+
+        for category, lines, downloads in reports:
+            print(f"\n{'Listing' if list_only else 'Downloading'} {category}/")
+            for line in lines:
+                print(line)
+
+            for filename, local_file, gunzip, time_str, download in downloads:
+                if download is None:
+                    stats['unchanged'] += 1
+                    print(f"  {filename} (unchanged, {time_str})")
+                    continue
+
+                ok, download_lines = download.result()
+                for line in download_lines:
+                    print(line)
+                if not ok:
+                    stats['failed'] += 1
+                    continue
 
-            if list_only:
-                try:
-                    size = ftp.size(filename)
-                    print(f"  {filename} ({size:,} bytes, {time_str})")
-                except:
-                    print(f"  {filename} ({time_str})")
-                continue
-
-            # Download the file
-            if download_file(ftp, filename, local_file):
                 size = local_file.stat().st_size
                 stats['downloaded'] += 1
                 stats['bytes'] += size
                 print(f"  {filename} ({size:,} bytes, {time_str})")
+                if gunzip:
+                    print(f"    -> decompressed to {local_file.name}")
+    except BaseException:
+        # On Ctrl+C or a failed listing, drop everything still queued
+        # rather than waiting for it. Transfers already running abort at
+        # their next block (or hit FTP_TIMEOUT) and close their own
+        # connections, since only the borrowing thread may touch one
+        stop.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    else:
+        executor.shutdown()
+    finally:
+        pool.close()
 
-                # Decompress .gz files
-                if decompress and filename.endswith('.gz'):
-                    decompressed = decompress_gzip(local_file)
-                    if decompressed != local_file:
-                        print(f"    -> decompressed to {decompressed.name}")
-            else:
-                stats['failed'] += 1
-
-    ftp.quit()
     return stats
 
 
@@ -253,6 +496,7 @@ Examples:
   python scripts/fetch-prod-logs.py --since "Jan 25 2pm"   # Since specific time
   python scripts/fetch-prod-logs.py --list                 # List files only
   python scripts/fetch-prod-logs.py --list --since "1 day ago"  # List recent
+  python scripts/fetch-prod-logs.py -o /tmp/prod           # Re-runs skip unchanged files
         """
     )
     parser.add_argument('--since', type=str,
@@ -314,6 +558,8 @@ Examples:
         print(f"  Files downloaded: {stats['downloaded']}")
         if stats['skipped']:
             print(f"  Files skipped (older than --since): {stats['skipped']}")
+        if stats['unchanged']:
+            print(f"  Files unchanged since last fetch: {stats['unchanged']}")
         print(f"  Total size: {stats['bytes']:,} bytes ({stats['bytes']/1024/1024:.1f} MB)")
         if stats['failed']:
             print(f"  Failed: {stats['failed']}")
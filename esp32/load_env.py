@@ -1,17 +1,20 @@
 Import("env")
 import os
+import re
+
+# Same rules as the old strip/split loop, except that "=value" lines with
+# an empty key are now dropped instead of defining an empty macro name
+ENV_LINE_RE = re.compile(r'^[ \t]*([^#=\s][^=\n]*)=(.*?)[ \t]*$', re.MULTILINE)
 
 # Load .env file
 env_file = os.path.join(env.get("PROJECT_DIR"), ".env")
 if os.path.exists(env_file):
     with open(env_file) as f:
-        for line in f:
-            line = line.strip()
-            if line and not line.startswith("#") and "=" in line:
-                key, value = line.split("=", 1)
-                # Add as build flag with proper escaping for strings
-                env.Append(CPPDEFINES=[
-                    (key, env.StringifyMacro(value))
-                ])
+        text = f.read().replace("\r", "")
+    for key, value in ENV_LINE_RE.findall(text):
+        # Add as build flag with proper escaping for strings
+        env.Append(CPPDEFINES=[
+            (key, env.StringifyMacro(value))
+        ])
 else:
     print("WARNING: .env file not found! Copy .env.example to .env")